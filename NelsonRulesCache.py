@@ -0,0 +1,145 @@
+import os
+import hashlib
+import numpy as np
+
+
+def data_hash(original):
+    '''Returns a hex digest of the contents of a series or array.
+    Values, dtype and length are hashed; the index is not, since rules work
+    on positions only.'''
+    values = np.ascontiguousarray(np.asarray(original))
+    h = hashlib.sha1()
+    h.update(str(values.dtype).encode())
+    h.update(str(values.shape).encode())
+    h.update(memoryview(values).cast('B'))
+    return h.hexdigest()
+
+
+def pack_mask(mask):
+    '''Packs a boolean mask into bytes, 8 data points per byte.'''
+    return np.packbits(np.asarray(mask, dtype=bool)).tobytes()
+
+
+def unpack_mask(buf, length):
+    '''Inverse of pack_mask. length is the number of data points.'''
+    return np.unpackbits(np.frombuffer(buf, dtype=np.uint8),
+                         count=length).astype(bool)
+
+
+class ResultCache:
+    '''On-disk cache of rule masks.
+
+    Each entry is a single file holding a bit-packed boolean mask. Entries are
+    keyed by the content hash of the data together with the rule name and the
+    parameters the rule was called with, so changing a constant only
+    recomputes the affected rule. Disk space taken by the entries (allocated
+    blocks, not just file lengths) is kept under max_bytes: when a put goes
+    over it, least recently used entries are evicted down to low_water times
+    max_bytes, so the directory is only scanned once in a while.
+    Example:
+    >>>cache = ResultCache('nr_cache', max_bytes=50*2**20)
+    >>>key = cache.key(data_hash(series), 'rule2', K=9)
+    >>>mask = cache.get(key, len(series))   # None on a miss
+    >>>cache.put(key, mask)
+    '''
+
+    suffix = '.mask'
+
+    def __init__(self, cache_dir='nr_cache', max_bytes=100*2**20, low_water=0.8):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.total_bytes = sum(size for mtime, size, path in self._entries())
+
+    def _disk_size(self, st):
+        '''Space a file takes on disk; falls back to its length where the
+        platform does not report allocated blocks.'''
+        if hasattr(st, 'st_blocks'):
+            return st.st_blocks * 512
+        return st.st_size
+
+    def _entries(self):
+        '''(mtime, disk size, path) of every entry in the cache directory.'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, self._disk_size(st), path))
+        return entries
+
+    def key(self, digest, rule_name, **params):
+        '''Builds an entry key from a data digest, rule name and rule parameters.'''
+        h = hashlib.sha1()
+        h.update(digest.encode())
+        h.update(rule_name.encode())
+        for name in sorted(params):
+            h.update(('%s=%r;' % (name, params[name])).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key, length):
+        '''Returns the cached mask for key as a boolean array, or None.'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                buf = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        if len(buf) != (length + 7) // 8:
+            # stale or truncated entry
+            self.misses += 1
+            return None
+        os.utime(path, None) # mark as recently used
+        self.hits += 1
+        return unpack_mask(buf, length)
+
+    def put(self, key, mask):
+        '''Stores mask under key and evicts old entries if over max_bytes.'''
+        path = self._path(key)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(pack_mask(mask))
+        try:
+            self.total_bytes -= self._disk_size(os.stat(path))
+        except OSError:
+            pass
+        os.replace(tmp, path)
+        self.total_bytes += self._disk_size(os.stat(path))
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits
+        low_water times max_bytes. Also resyncs the running total with the
+        directory, e.g. when several processes share it.'''
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        target = self.max_bytes * self.low_water
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.total_bytes = total
+
+    def clear(self):
+        '''Removes every entry from the cache.'''
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.suffix):
+                os.remove(os.path.join(self.cache_dir, name))
+        self.total_bytes = 0
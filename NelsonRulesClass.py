@@ -3,6 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy import fftpack
 from scipy.stats import trimboth, trim1
+from NelsonRulesCache import ResultCache, data_hash
+from NelsonRulesLowMem import LowMemoryRules
 '''https://github.com/tannerdietrich/nelsonRules'''
 
 class NelsonRules:
@@ -23,6 +25,7 @@ class NelsonRules:
 
         self.__glob_rules_= ['rule1','rule2','rule3','rule4','rule5','rule6',
                             'rule7','rule8', 'rule9','rule10','rule11']
+        self.cache = None
         # # IDEA: : Pass rule numbers to initialize NelsonRules instance
         # # IDEA: : Add a new attribute: self.rules
         return
@@ -39,6 +42,36 @@ class NelsonRules:
         '''
         self.rule_dict[rule_num]=constant
 
+    def set_cache(self,cache_dir='nr_cache',max_bytes=100*2**20):
+        '''Enables an on-disk result cache for apply_rules and search_K.
+        Rule masks are stored per data content, rule, K and parameters, so
+        re-running the same series only recomputes rules whose constants
+        changed. Pass cache_dir=None to disable caching.
+        Example:
+        >>>nr = NelsonRules()
+        >>>nr.set_cache('nr_cache',max_bytes=50*2**20)
+        >>>nr.apply_rules(df['col'],plots=False) # computes and stores
+        >>>nr.set_constant(2,12)
+        >>>nr.apply_rules(df['col'],plots=False) # only rule2 is recomputed
+        '''
+        if cache_dir is None:
+            self.cache = None
+        else:
+            self.cache = ResultCache(cache_dir,max_bytes=max_bytes)
+
+    def _call_rule(self,rule,original,digest,mean,sigma,**kwargs):
+        '''Calls rule, going through the result cache if one is set.'''
+        if self.cache is None:
+            return rule(original, mean, sigma, **kwargs)
+        key = self.cache.key(digest, rule.__name__, mean=float(mean),
+                             sigma=float(sigma), **kwargs)
+        cached = self.cache.get(key, len(original))
+        if cached is not None:
+            return cached
+        results = rule(original, mean, sigma, **kwargs)
+        self.cache.put(key, results)
+        return results
+
 
     def _sliding_chunker(self,original, segment_len, slide_len):
         """Split a list into a series of sub-lists...
@@ -212,13 +245,20 @@ class NelsonRules:
 
     def apply_rules(self,original=None, rules='all', chart_type=1,
                     var_name='',prefix='',plots=True,dpi=300,delta=0.001,p25=None,
-                    p75 = None, tukey_thr=1.5,out_thr_grad=3.):
+                    p75 = None, tukey_thr=1.5,out_thr_grad=3.,low_memory=False):
         '''Applies selected rules(default=all) to a given Pandas series object
         Returns a DataFrame with labels for each data point for given rules.
         True indicates violation
         Example:
         >>>rule_table,fig = nelsonRules.apply_rules(df['col'],var_name='col',prefix='save_filename_')
         see NelsonRules.set_constant() for changing rule constants.
+
+        low_memory=True accepts numpy arrays (float32, read-only or
+        memory-mapped) as well as series and evaluates them without copying
+        or upcasting. It returns a dict of boolean arrays, one per requested
+        rule, and makes no plots.
+        >>>values = np.load('tag.npy',mmap_mode='r')
+        >>>masks = nelsonRules.apply_rules(values,rules=[2,7],low_memory=True)
         '''
         assert(type(original)!=pd.DataFrame),'original must be a pandas series object'
         if (original.dtype=='O'): # object
@@ -227,6 +267,10 @@ class NelsonRules:
         if not original.ndim==1: # dim
             print('----> Error: Dim [%s] is not 1' % var_name)
             return(pd.DataFrame(),plt.figure())
+        if low_memory:
+            rule_nums = range(1,12) if rules == 'all' else rules
+            return self._low_memory_masks(original,
+                        [('rule'+str(r), r, self.rule_dict[r]) for r in rule_nums])
 
         mean = original.mean()
         sigma = original.std()
@@ -239,20 +283,24 @@ class NelsonRules:
             rules = rule_handle
         elif isinstance(rules,list):
             rules = [rule_handle[i-1] for i in rule_nums]
+        digest = data_hash(original) if self.cache is not None else None
         df = pd.DataFrame(original)
         for i in range(len(rules)):
             if rules[i].__name__ != 'rule10' or rules[i].__name__ != 'rule11':
-                df[rules[i].__name__] = rules[i](original, mean, sigma,
+                df[rules[i].__name__] = self._call_rule(rules[i], original, digest,
+                                        mean, sigma,
                                         K=rule_dict[rule_handle.index(rules[i])+1])
 
             elif rules[i].__name__ == 'rule11':
-                df[rules[i].__name__] = rules[i](original, mean, sigma,
+                df[rules[i].__name__] = self._call_rule(rules[i], original, digest,
+                                        mean, sigma,
                                         delta=delta,
                                         K=rule_dict[rule_handle.index(rules[i])+1],
                                         p25=p25,p75=p75)
 
             else:
-                df[rules[i].__name__] = rules[i](original, mean, sigma,
+                df[rules[i].__name__] = self._call_rule(rules[i], original, digest,
+                                                mean, sigma,
                                                 delta=delta,
                                                 K=rule_dict[rule_handle.index(rules[i])+1],
                                                 out_thr_grad=out_thr_grad)
@@ -262,6 +310,26 @@ class NelsonRules:
         return df
 
 
+    def _low_memory_masks(self,original,jobs):
+        '''Evaluates (name, rule number, K) jobs with LowMemoryRules.
+        Scratch buffers are shared by all jobs and the input is only read.'''
+        values = np.asarray(original)
+        evaluator = LowMemoryRules(values)
+        digest = data_hash(values) if self.cache is not None else None
+        masks = {}
+        for name, rule_num, K in jobs:
+            if self.cache is None:
+                masks[name] = evaluator.evaluate(rule_num, K)
+                continue
+            key = self.cache.key(digest, 'rule'+str(rule_num), K=K,
+                                 low_memory=True)
+            masks[name] = self.cache.get(key, len(values))
+            if masks[name] is None:
+                masks[name] = evaluator.evaluate(rule_num, K)
+                self.cache.put(key, masks[name])
+        return masks
+
+
     def rule1(self,original, mean=None, sigma=None,K=3):
         """One point is more than 3 standard deviations from the mean."""
         if mean is None:
@@ -621,8 +689,11 @@ class NelsonRules:
             frames[i].to_csv(prefix+'frame_'+i+'.csv')
         plt.close('all')
 
-    def search_K(self,original,rule,K_list,plots=False,var_name='',prefix='',dpi=300):
-        '''Searches for the optimal value of K for given rule'''
+    def search_K(self,original,rule,K_list,plots=False,var_name='',prefix='',dpi=300,
+                 low_memory=False):
+        '''Searches for the optimal value of K for given rule
+        With low_memory=True the first returned value is a dict of boolean
+        arrays keyed 'K=..' instead of a DataFrame (see apply_rules).'''
         assert(type(original)!=pd.DataFrame),'original must be a pandas series object'
         if (original.dtype=='O'): # object
             print('----> Error: variable [%s] is Object' % var_name)
@@ -630,6 +701,13 @@ class NelsonRules:
         if not original.ndim==1: # dim
             print('----> Error: Dim [%s] is not 1' % var_name)
             return(pd.DataFrame(),plt.figure())
+        if low_memory:
+            masks = self._low_memory_masks(original,
+                        [('K='+str(K), rule, K) for K in K_list])
+            information_lost = {}
+            for name in masks:
+                information_lost[name] = masks[name].sum()/len(masks[name])
+            return masks,information_lost
 
         mean = original.mean()
         sigma = original.std()
@@ -639,10 +717,12 @@ class NelsonRules:
                         self.rule9, self.rule10, self.rule11]
 
 
+        digest = data_hash(original) if self.cache is not None else None
         df = pd.DataFrame(original)
         information_lost = {}
         for i in range(len(K_list)):
-            df['K='+str(K_list[i])] = rule_handle[rule-1](original, mean, sigma, K=K_list[i])
+            df['K='+str(K_list[i])] = self._call_rule(rule_handle[rule-1], original,
+                                                      digest, mean, sigma, K=K_list[i])
             information_lost['K='+str(K_list[i])] = df['K='+str(K_list[i])].sum()/len(df['K='+str(K_list[i])])
         if plots==True:
             self.plot_rules_search_K(df,var_name=var_name,rule=rule,prefix=prefix,K_list=K_list)
@@ -0,0 +1,235 @@
+import numpy as np
+
+
+def moments(values, block=2**16):
+    '''Returns (count, mean, M2) of the non-NaN values of a 1-D array.
+    Works through the array in blocks so that no full-size temporary is
+    created, which keeps memory-mapped and float32 inputs as they are.
+    sigma = sqrt(M2/(count-1)), matching pandas' std().'''
+    acc = (0, 0., 0.)
+    for pos in range(0, len(values), block):
+        chunk = values[pos:pos + block]
+        chunk = chunk[~np.isnan(chunk)] if chunk.dtype.kind == 'f' else chunk
+        n = len(chunk)
+        if n == 0:
+            continue
+        mean = chunk.mean(dtype=np.float64)
+        m2 = ((chunk - mean) ** 2).sum(dtype=np.float64)
+        acc = merge_moments(acc, (n, mean, m2))
+    return acc
+
+
+def merge_moments(a, b):
+    '''Combines two (count, mean, M2) accumulators (Chan et al.).'''
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return (0, 0., 0.)
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / n
+    return (n, mean, m2)
+
+
+def moments_sigma(acc, ddof=1):
+    '''Standard deviation from a (count, mean, M2) accumulator.'''
+    n, mean, m2 = acc
+    if n - ddof <= 0:
+        return np.nan
+    return np.sqrt(m2 / (n - ddof))
+
+
+class LowMemoryRules:
+    '''Vectorized rule evaluation for large or memory-mapped series.
+
+    The input array is never copied or upcast: rules read it through numpy
+    ufuncs and write into three boolean scratch buffers (and one gradient
+    buffer for rules 9 and 10) that are shared by all rules. Only the mask
+    of each evaluated rule is allocated. Results match NelsonRules.rule1-11
+    as called from apply_rules.
+    Example:
+    >>>values = np.load('tag.npy', mmap_mode='r') # float32
+    >>>lm = LowMemoryRules(values)
+    >>>mask = lm.evaluate(2, K=9)
+
+    mean, sigma, der_moments (moments of the gradient of the non-NaN values,
+    used by rule 10) and quartiles ((p25, p75), used by rule 11) are computed
+    from values unless given, e.g. when values is one block of a longer
+    series.
+    '''
+
+    def __init__(self, values, mean=None, sigma=None, der_moments=None,
+                 quartiles=None):
+        self.values = values
+        self.der_moments = der_moments
+        self.quartiles = quartiles
+        n = len(values)
+        self._a = np.empty(n, dtype=bool)
+        self._b = np.empty(n, dtype=bool)
+        self._c = np.empty(n, dtype=bool)
+        self._grad = None
+        if values.dtype.kind == 'f':
+            self.has_nan = bool(np.isnan(values, out=self._a).any())
+        else:
+            self.has_nan = False
+        if mean is None or sigma is None:
+            acc = moments(values)
+            if mean is None:
+                mean = acc[1] if acc[0] else np.nan
+            if sigma is None:
+                sigma = moments_sigma(acc)
+        self.mean = np.float64(mean)
+        self.sigma = np.float64(sigma)
+
+    def _window_all(self, cond, w, out):
+        '''out[i] = all(cond[i:i+w]) for every window start of a K long
+        chunk of the data; the remaining starts are set to False.'''
+        nv = max(min(len(cond) - w + 1, len(out)), 0)
+        if w <= 0:
+            out[:nv] = True
+        else:
+            out[:nv] = cond[:nv]
+            for k in range(1, w):
+                out[:nv] &= cond[k:k + nv]
+        out[nv:] = False
+        return out
+
+    def _dilate(self, starts, K):
+        '''Marks every point of each qualified chunk, like _clean_chunks.'''
+        n = len(starts)
+        results = starts.copy()
+        for k in range(1, min(K, n)):
+            results[k:] |= starts[:n - k]
+        return results
+
+    def _gradient(self):
+        '''np.gradient of the data, computed once into a reused buffer.'''
+        if self._grad is None:
+            x = self.values
+            dtype = x.dtype if x.dtype.kind == 'f' else np.float64
+            g = np.empty(len(x), dtype=dtype)
+            g[0] = x[1] - x[0]
+            g[-1] = x[-1] - x[-2]
+            np.subtract(x[2:], x[:-2], out=g[1:-1])
+            g[1:-1] /= 2.
+            self._grad = g
+        return self._grad
+
+    def _all_or_none(self, cond_fn, K):
+        '''Chunks where cond holds for every point or for none of them.'''
+        a, b, c = self._a, self._b, self._c
+        cond_fn(a)
+        self._window_all(a, K, b)
+        np.logical_not(a, out=a)
+        self._window_all(a, K, c)
+        b |= c
+        return self._dilate(b, K)
+
+    def evaluate(self, rule_num, K):
+        '''Returns the boolean violation mask of rule rule_num with constant K.'''
+        x = self.values
+        n = len(x)
+        mean, sigma = self.mean, self.sigma
+        a, b, c = self._a, self._b, self._c
+        if rule_num == 1:
+            results = np.less(x, mean - sigma * K)
+            results |= np.greater(x, mean + sigma * K, out=a)
+            return results
+        elif rule_num == 2:
+            return self._all_or_none(lambda out: np.greater(x, mean, out=out), K)
+        elif rule_num == 3:
+            np.less(x[:-1], x[1:], out=a[:n - 1])
+            self._window_all(a[:n - 1], K - 1, b)
+            np.greater(x[:-1], x[1:], out=a[:n - 1])
+            self._window_all(a[:n - 1], K - 1, c)
+            b |= c
+            return self._dilate(b, K)
+        elif rule_num == 4:
+            np.less(x[:-1], x[1:], out=a[:n - 1])
+            np.not_equal(a[:n - 2], a[1:n - 1], out=b[:n - 2])
+            self._window_all(b[:n - 2], K - 2, c)
+            return self._dilate(c, K)
+        elif rule_num in (5, 6):
+            width = sigma * 2 if rule_num == 5 else sigma
+            np.greater(x, mean + width, out=a)
+            self._window_all(a, K, b)
+            np.less(x, mean - width, out=a)
+            self._window_all(a, K, c)
+            b |= c
+            return self._dilate(b, K)
+        elif rule_num == 7:
+            np.greater(x, mean - sigma, out=a)
+            np.less(x, mean + sigma, out=b)
+            a &= b
+            self._window_all(a, K, c)
+            return self._dilate(c, K)
+        elif rule_num == 8:
+            lo, hi = mean - sigma, mean + sigma
+            np.less(x, lo, out=a)
+            np.greater(x, hi, out=b)
+            a |= b
+            self._window_all(a, K, c)
+            # any(x < lo) == not all(x >= lo); NaN counts as not below
+            np.less(x, lo, out=a)
+            np.logical_not(a, out=a)
+            self._window_all(a, K, b)
+            np.logical_not(b, out=b)
+            c &= b
+            np.greater(x, hi, out=a)
+            np.logical_not(a, out=a)
+            self._window_all(a, K, b)
+            np.logical_not(b, out=b)
+            c &= b
+            return self._dilate(c, K)
+        elif rule_num == 9:
+            delta = 0.001
+            g = self._gradient()
+            np.less(g, delta, out=a)
+            np.greater(g, -delta, out=b)
+            a &= b
+            self._window_all(a, K, c)
+            return self._dilate(c, K)
+        elif rule_num == 10:
+            out_thr_grad = 2.5
+            g = self._gradient()
+            if self.der_moments is not None:
+                acc = self.der_moments
+            elif self.has_nan:
+                # thresholds come from the gradient of the non-NaN values only
+                acc = moments(np.gradient(x[~np.isnan(x)]))
+            else:
+                acc = moments(g)
+            x_der_sigma = moments_sigma(acc, ddof=0)
+            x_der_bot = acc[1] - x_der_sigma * out_thr_grad
+            x_der_top = acc[1] + x_der_sigma * out_thr_grad
+            return self._any_both(g, x_der_bot, x_der_top, K)
+        elif rule_num == 11:
+            if self.quartiles is not None:
+                p25, p75 = self.quartiles
+            else:
+                # the percentile partition needs one temporary copy of the data
+                finite = x[~np.isnan(x)] if self.has_nan else x
+                p25 = np.percentile(finite, 25)
+                p75 = np.percentile(finite, 75)
+            IQR = p75 - p25
+            results = np.greater(x, p75 + K * IQR)
+            results |= np.less(x, p25 - K * IQR, out=a)
+            return results
+        raise ValueError('unknown rule %s' % rule_num)
+
+    def _any_both(self, g, bot, top, K):
+        '''Chunks with at least one value above top and one below bot.'''
+        a, b, c = self._a, self._b, self._c
+        nv = max(len(g) - K + 1, 0)
+        np.greater(g, top, out=a)
+        np.logical_not(a, out=a)
+        self._window_all(a, K, b)
+        np.logical_not(b, out=b)
+        np.less(g, bot, out=a)
+        np.logical_not(a, out=a)
+        self._window_all(a, K, c)
+        np.logical_not(c, out=c)
+        b &= c
+        b[nv:] = False
+        return self._dilate(b, K)
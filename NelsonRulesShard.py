@@ -0,0 +1,325 @@
+'''Sharded execution of NelsonRules over columns or time blocks.
+
+Work units are plain dicts serialized with serialize() and dispatched through
+a backend. A backend is any object with a map(func, items) method that
+returns the results in the order of items; SerialBackend and LocalBackend
+(multiprocessing) are provided, a remote backend only has to ship the
+serialized units to hosts that can import this module and run func there.'''
+import zlib
+import pickle
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from NelsonRulesCache import pack_mask, unpack_mask
+from NelsonRulesLowMem import LowMemoryRules, moments, merge_moments, moments_sigma
+
+
+def serialize(obj):
+    '''Compact binary form of a work unit or result.'''
+    return zlib.compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+
+def deserialize(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+class QuantileSketch:
+    '''Mergeable, deterministic quantile sketch.
+
+    Holds sorted (value, weight) centroids. While the number of values is at
+    most size the sketch is exact and quantile() matches np.percentile; past
+    that, centroids of equal weight are merged, giving a rank error of about
+    1/size.
+    Example:
+    >>>a = QuantileSketch(block1); b = QuantileSketch(block2)
+    >>>a.merge(b).quantile(25)
+    '''
+
+    def __init__(self, values=None, size=4096):
+        self.size = size
+        self.values = np.empty(0)
+        self.weights = np.empty(0)
+        if values is not None:
+            values = np.asarray(values, dtype=np.float64)
+            values = values[~np.isnan(values)]
+            self._set(values, np.ones(len(values)))
+
+    def _set(self, values, weights):
+        order = np.argsort(values, kind='mergesort')
+        values, weights = values[order], weights[order]
+        if len(values) > self.size:
+            # split into size buckets of (nearly) equal weight
+            cum = np.cumsum(weights)
+            bucket = np.minimum((cum - weights) * self.size // cum[-1],
+                                self.size - 1).astype(int)
+            w = np.bincount(bucket, weights=weights, minlength=self.size)
+            v = np.bincount(bucket, weights=values * weights, minlength=self.size)
+            keep = w > 0
+            values, weights = v[keep] / w[keep], w[keep]
+        self.values, self.weights = values, weights
+
+    def merge(self, other):
+        '''Returns a new sketch holding the values of both sketches.'''
+        merged = QuantileSketch(size=self.size)
+        merged._set(np.concatenate([self.values, other.values]),
+                    np.concatenate([self.weights, other.weights]))
+        return merged
+
+    def quantile(self, q):
+        '''q-th percentile (0-100) of the sketched values.'''
+        if len(self.values) == 0:
+            return np.nan
+        if np.all(self.weights == 1):
+            return np.percentile(self.values, q)
+        # centroid k sits at the middle of its rank range
+        ranks = np.cumsum(self.weights) - self.weights / 2.
+        return np.interp(q / 100. * self.weights.sum(), ranks, self.values)
+
+
+class SerialBackend:
+    '''Runs work units one after the other in this process.'''
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+
+class LocalBackend:
+    '''Runs work units on a local multiprocessing pool.
+    Stands in for a multi-host coordinator when testing.'''
+
+    def __init__(self, processes=None):
+        self.processes = processes
+
+    def map(self, func, items):
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def run_stats_unit(blob):
+    '''Phase 1 of time-block sharding: mergeable statistics of one block.'''
+    unit = deserialize(blob)
+    values = unit['values']
+    finite = values[~np.isnan(values)]
+    # gradient of the non-NaN values, using the nearest non-NaN neighbours
+    # outside the block so that block borders match the unsplit series
+    seq = [finite]
+    if unit['left'] is not None:
+        seq.insert(0, [unit['left']])
+    if unit['right'] is not None:
+        seq.append([unit['right']])
+    seq = np.concatenate(seq).astype(values.dtype)
+    der_moments = (0, 0., 0.)
+    if len(seq) >= 2:
+        x_der = np.gradient(seq)
+        start = 1 if unit['left'] is not None else 0
+        der_moments = moments(x_der[start:start + len(finite)])
+    sketch = None
+    if unit['sketch_size']:
+        sketch = QuantileSketch(finite, size=unit['sketch_size'])
+    return serialize({'id': unit['id'], 'column': unit['column'],
+                      'moments': moments(values), 'der_moments': der_moments,
+                      'sketch': sketch})
+
+
+def run_rules_unit(blob):
+    '''Phase 2: evaluates the rule jobs of one unit and keeps its own part.'''
+    unit = deserialize(blob)
+    stats = unit['stats'] or {}
+    evaluator = LowMemoryRules(unit['values'], mean=stats.get('mean'),
+                               sigma=stats.get('sigma'),
+                               der_moments=stats.get('der_moments'),
+                               quartiles=stats.get('quartiles'))
+    offset, length = unit['offset'], unit['length']
+    masks = {}
+    for name, rule_num, K in unit['jobs']:
+        mask = evaluator.evaluate(rule_num, K)
+        masks[name] = pack_mask(mask[offset:offset + length])
+    return serialize({'id': unit['id'], 'column': unit['column'],
+                      'start': unit['start'], 'length': length, 'masks': masks,
+                      'mean': float(evaluator.mean),
+                      'sigma': float(evaluator.sigma)})
+
+
+def _nearest_finite(values, pos, step):
+    '''First non-NaN value from pos going in step direction, or None.'''
+    n = len(values)
+    while 0 <= pos < n:
+        if step < 0:
+            lo = max(pos - 4095, 0)
+            chunk = values[lo:pos + 1]
+            idx = np.flatnonzero(~np.isnan(chunk))
+            if len(idx):
+                return chunk[idx[-1]]
+            pos = lo - 1
+        else:
+            chunk = values[pos:pos + 4096]
+            idx = np.flatnonzero(~np.isnan(chunk))
+            if len(idx):
+                return chunk[idx[0]]
+            pos += 4096
+    return None
+
+
+class ShardedNelsonRules:
+    '''Runs apply_rules/search_K over many columns or long series by
+    splitting them into work units.
+
+    by='columns' makes one unit per column; every column is evaluated exactly
+    as NelsonRules.apply_rules(..., low_memory=True) would.
+    by='time' additionally splits each column into blocks of block_size
+    points. Blocks overlap by K points on both sides so windowed rules see
+    the same chunks as on the whole series. Mean/sigma and the rule 10
+    gradient statistics are merged from per-block accumulators first, so
+    they equal the unsplit values up to rounding. Rule 11 quartiles come from
+    a QuantileSketch and are exact only while a column has at most
+    sketch_size points.
+
+    Results are merged in unit order and do not depend on the backend.
+    Statistics used for every column are kept in self.stats.
+    Example:
+    >>>snr = ShardedNelsonRules(NelsonRules(), backend=LocalBackend(4))
+    >>>frames = snr.apply_rules(df, rules=[2,7])
+    >>>frames['col']['rule2']
+    >>>frames,info_lost = snr.search_K(df, 9, range(8,17), by='time')
+    '''
+
+    def __init__(self, nr=None, backend=None, block_size=10**6, sketch_size=4096):
+        if nr is None:
+            from NelsonRulesClass import NelsonRules
+            nr = NelsonRules()
+        self.nr = nr
+        self.backend = backend if backend is not None else LocalBackend()
+        self.block_size = block_size
+        self.sketch_size = sketch_size
+        self.stats = {}
+
+    def apply_rules(self, data, rules='all', by='columns'):
+        '''Sharded NelsonRules.apply_rules. data is a DataFrame or Series.
+        Returns a dict of DataFrames of violation labels keyed by column.'''
+        rule_nums = range(1, 12) if rules == 'all' else rules
+        jobs = [('rule'+str(r), r, self.nr.rule_dict[r]) for r in rule_nums]
+        return self._run(data, jobs, by)
+
+    def search_K(self, data, rule, K_list, by='columns'):
+        '''Sharded NelsonRules.search_K. Returns a dict of DataFrames keyed by
+        column and the information lost per column and K.'''
+        jobs = [('K='+str(K), rule, K) for K in K_list]
+        frames = self._run(data, jobs, by)
+        information_lost = {}
+        for col in frames:
+            information_lost[col] = {}
+            for name in frames[col].columns:
+                information_lost[col][name] = frames[col][name].sum()/len(frames[col])
+        return frames, information_lost
+
+    def _columns(self, data):
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        columns = []
+        for col in data.columns:
+            if data[col].dtype == 'O':
+                print('----> Error: variable [%s] is Object' % col)
+                continue
+            columns.append(col)
+        return data, columns
+
+    def _blocks(self, n, by):
+        if by not in ('columns', 'time'):
+            raise ValueError("by must be 'columns' or 'time'")
+        if by == 'columns' or n <= self.block_size:
+            return [(0, n)]
+        return [(s, min(s + self.block_size, n))
+                for s in range(0, n, self.block_size)]
+
+    def _run(self, data, jobs, by):
+        data, columns = self._columns(data)
+        n = len(data)
+        blocks = self._blocks(n, by)
+        # windowed rules need K points of context on both sides
+        overlap = int(max([K for name, r, K in jobs if r not in (1, 11)] or [0]))
+        need_quartiles = any(r == 11 for name, r, K in jobs)
+
+        stats = {}
+        if len(blocks) > 1:
+            stats = self._merged_stats(data, columns, blocks, need_quartiles)
+
+        units = []
+        for col in columns:
+            values = np.asarray(data[col])
+            for start, end in blocks:
+                lo, hi = max(start - overlap, 0), min(end + overlap, n)
+                units.append(serialize({'id': len(units), 'column': col,
+                                        'start': start, 'offset': start - lo,
+                                        'length': end - start,
+                                        'values': values[lo:hi], 'jobs': jobs,
+                                        'stats': stats.get(col)}))
+        results = [deserialize(blob) for blob in
+                   self.backend.map(run_rules_unit, units)]
+        results.sort(key=lambda r: r['id'])
+
+        masks = dict((col, dict((name, np.zeros(n, dtype=bool))
+                                for name, r, K in jobs)) for col in columns)
+        self.stats = {}
+        for result in results:
+            col, start, length = result['column'], result['start'], result['length']
+            for name in result['masks']:
+                masks[col][name][start:start + length] = \
+                    unpack_mask(result['masks'][name], length)
+            self.stats[col] = {'mean': result['mean'], 'sigma': result['sigma']}
+            if col in stats:
+                self.stats[col]['count'] = stats[col]['count']
+                if stats[col]['quartiles'] is not None:
+                    self.stats[col]['p25'], self.stats[col]['p75'] = \
+                        stats[col]['quartiles']
+
+        frames = {}
+        for col in columns:
+            frames[col] = pd.DataFrame(masks[col], index=data.index,
+                                       columns=[name for name, r, K in jobs])
+        return frames
+
+    def _merged_stats(self, data, columns, blocks, need_quartiles):
+        '''Phase 1: per-block accumulators merged into per-column statistics.'''
+        units = []
+        for col in columns:
+            values = np.asarray(data[col])
+            for start, end in blocks:
+                units.append(serialize({
+                    'id': len(units), 'column': col, 'values': values[start:end],
+                    'left': _nearest_finite(values, start - 1, -1),
+                    'right': _nearest_finite(values, end, 1),
+                    'sketch_size': self.sketch_size if need_quartiles else 0}))
+        results = [deserialize(blob) for blob in
+                   self.backend.map(run_stats_unit, units)]
+        results.sort(key=lambda r: r['id'])
+
+        merged = {}
+        for result in results:
+            col = result['column']
+            if col not in merged:
+                merged[col] = result
+                continue
+            acc = merged[col]
+            acc['moments'] = merge_moments(acc['moments'], result['moments'])
+            acc['der_moments'] = merge_moments(acc['der_moments'],
+                                               result['der_moments'])
+            if acc['sketch'] is not None:
+                acc['sketch'] = acc['sketch'].merge(result['sketch'])
+
+        stats = {}
+        for col in merged:
+            acc = merged[col]
+            quartiles = None
+            if acc['sketch'] is not None:
+                quartiles = (acc['sketch'].quantile(25), acc['sketch'].quantile(75))
+            stats[col] = {'count': acc['moments'][0],
+                          'mean': acc['moments'][1] if acc['moments'][0] else np.nan,
+                          'sigma': moments_sigma(acc['moments']),
+                          'der_moments': acc['der_moments'],
+                          'quartiles': quartiles}
+        return stats
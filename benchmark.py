@@ -0,0 +1,60 @@
+import sys
+import os
+import time
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from NelsonRulesClass import NelsonRules
+
+# usage: python benchmark.py [n_points] [n_points_low_memory]
+# Reports run time and peak traced memory of apply_rules (all rules) for the
+# default path and for low_memory=True on a memory-mapped float32 series.
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+n_low = int(sys.argv[2]) if len(sys.argv) > 2 else 10**7
+
+nr = NelsonRules()
+
+
+def make_memmap(n, path):
+    data = np.memmap(path, dtype=np.float32, mode='w+', shape=(n,))
+    rs = np.random.RandomState(0)
+    for pos in range(0, n, 10**6):
+        data[pos:pos+10**6] = rs.randn(len(data[pos:pos+10**6]))
+    data.flush()
+    del data
+    return np.memmap(path, dtype=np.float32, mode='r', shape=(n,))
+
+
+def measure(label, func):
+    tracemalloc.start()
+    t = time.time()
+    func()
+    elapsed = time.time() - t
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-34s %10.3f s  peak %10.2f MB' % (label, elapsed, peak/2.**20))
+
+
+tmp = tempfile.mkdtemp()
+small = make_memmap(n, os.path.join(tmp, 'small.dat'))
+large = make_memmap(n_low, os.path.join(tmp, 'large.dat'))
+
+print('input: float32 memmap, %d points = %.2f MB' % (n, small.nbytes/2.**20))
+measure('apply_rules',
+        lambda: nr.apply_rules(pd.Series(small), plots=False))
+measure('apply_rules low_memory',
+        lambda: nr.apply_rules(small, plots=False, low_memory=True))
+
+print('input: float32 memmap, %d points = %.2f MB' % (n_low, large.nbytes/2.**20))
+measure('apply_rules low_memory',
+        lambda: nr.apply_rules(large, plots=False, low_memory=True))
+measure('apply_rules low_memory rules=[2]',
+        lambda: nr.apply_rules(large, rules=[2], plots=False, low_memory=True))
+
+del small, large
+for name in os.listdir(tmp):
+    os.remove(os.path.join(tmp, name))
+os.rmdir(tmp)
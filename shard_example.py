@@ -0,0 +1,23 @@
+import pandas as pd
+from NelsonRulesClass import NelsonRules
+from NelsonRulesShard import ShardedNelsonRules, LocalBackend
+
+if __name__ == '__main__': # required by multiprocessing on some platforms
+    nr = NelsonRules()
+    nr.set_constant(3,7) #New constant for Rule 3 is set to 7 (previously 6)
+    data = pd.read_csv('data.csv')
+
+    snr = ShardedNelsonRules(nr, backend=LocalBackend(4))
+
+    # one work unit per column
+    frames = snr.apply_rules(data, rules=[2,7])
+
+    # long series: every column is also split into time blocks
+    snr.block_size = 100000
+    frames, info_lost = snr.search_K(data, 9, range(8,17), by='time')
+
+    #to retrieve results of a specific K value (i.e. 12) for a column, use:
+    #>>>frames[col]['K=12']
+
+    #mean/sigma (and quartiles for rule 11) merged over blocks, per column:
+    #>>>snr.stats[col]